@@ -1,8 +1,41 @@
+from math import fsum
+
 import frappe
 from frappe import _
 from frappe.model.document import Document
 from frappe.utils import flt, nowdate, now
 
+from gl_fix_tool.utils import riv_available, riv_has_posting_date
+
+_GLE_AMOUNT_FIELDS = (
+    "debit",
+    "credit",
+    "debit_in_account_currency",
+    "credit_in_account_currency",
+    "debit_in_transaction_currency",
+    "credit_in_transaction_currency",
+)
+
+# GL Entry fields that a correction may change / compares against
+_GLE_CHECK_FIELDS = ("account", "cost_center", *_GLE_AMOUNT_FIELDS)
+
+# Voucher types Repost Item Valuation is normally used for
+_STOCK_VOUCHER_TYPES = frozenset(
+    {"Purchase Receipt", "Stock Entry", "Purchase Invoice", "Sales Invoice"}
+)
+
+# GL Correction Line snapshot field -> GL Entry field
+_ORIG_MAP = {
+    "original_account": "account",
+    "original_cost_center": "cost_center",
+    "original_debit": "debit",
+    "original_credit": "credit",
+    "original_debit_in_account_currency": "debit_in_account_currency",
+    "original_credit_in_account_currency": "credit_in_account_currency",
+    "original_debit_in_transaction_currency": "debit_in_transaction_currency",
+    "original_credit_in_transaction_currency": "credit_in_transaction_currency",
+}
+
 
 class GLCorrection(Document):
     """
@@ -26,39 +59,40 @@ class GLCorrection(Document):
         self.update_totals()
         self.validate_totals()
 
-    def on_submit(self):
+    def before_submit(self):
         """
         On submit:
         - Just mark this correction as Applied (approved).
         - Actual GL changes happen only when "Apply GL Updates" is clicked.
+        Set before the submit write, so no extra UPDATE is needed.
         """
         self.status = "Applied"
-        frappe.db.set_value(self.doctype, self.name, "status", "Applied")
 
-    def on_cancel(self):
+    def before_cancel(self):
         """
         On cancel:
         - Mark this document as Cancelled.
         - We do NOT touch GL Entries automatically.
+        Set before the cancel write, so no extra UPDATE is needed.
         """
         self.status = "Cancelled"
-        frappe.db.set_value(self.doctype, self.name, "status", "Cancelled")
 
     def update_totals(self):
         """Sum all child rows and update total_debit / total_credit / difference."""
-        total_debit = 0.0
-        total_credit = 0.0
-
-        for row in self.entries or []:
-            total_debit += flt(row.debit)
-            total_credit += flt(row.credit)
+        rows = self.entries or []
 
-        self.total_debit = flt(total_debit)
-        self.total_credit = flt(total_credit)
-        self.difference = flt(total_debit - total_credit)
+        self.total_debit = flt(fsum(flt(row.debit) for row in rows))
+        self.total_credit = flt(fsum(flt(row.credit) for row in rows))
+        self.difference = flt(self.total_debit - self.total_credit)
 
     def validate_totals(self):
-        """Ensure debits and credits are balanced before submit."""
+        """
+        Ensure debits and credits are balanced before submit.
+        Draft saves (incl. autosave while rows are being edited) are not blocked.
+        """
+        if getattr(self, "_action", None) != "submit":
+            return
+
         if not self.entries:
             frappe.throw(_("Please add at least one row in Entries table."))
 
@@ -86,78 +120,89 @@ class GLCorrection(Document):
         if self.docstatus != 0:
             frappe.throw(_("You can only fetch GL Entries while the document is in Draft."))
 
-        if not self.company or not self.voucher_type or not self.voucher_no:
+        company, voucher_type, voucher_no = self.company, self.voucher_type, self.voucher_no
+
+        if not company or not voucher_type or not voucher_no:
             frappe.throw(_("Please set Company, Voucher Type and Voucher No first."))
 
-        gl_entries = frappe.get_all(
-            "GL Entry",
-            filters={
-                "company": self.company,
-                "voucher_type": self.voucher_type,
-                "voucher_no": self.voucher_no,
-                "is_cancelled": 0,
+        self.set("entries", [])
+
+        if self.is_new():
+            # Rows are attached by parent name, so the parent must exist first
+            self.insert(ignore_permissions=True)
+        else:
+            self.db_update()
+            frappe.db.delete(
+                "GL Correction Line",
+                {"parent": self.name, "parenttype": self.doctype, "parentfield": "entries"},
+            )
+
+        # Snapshot GL Entries straight into the child table, no Python round trip
+        frappe.db.sql(
+            """
+            INSERT INTO `tabGL Correction Line` (
+                name, parent, parenttype, parentfield, idx,
+                owner, modified_by, creation, modified,
+                account, party_type, party, cost_center, debit, credit, reference_gl_entry,
+                original_account, original_cost_center, original_debit, original_credit,
+                original_debit_in_account_currency, original_credit_in_account_currency,
+                original_debit_in_transaction_currency, original_credit_in_transaction_currency
+            )
+            SELECT
+                SUBSTRING(MD5(UUID()), 1, 10), %(parent)s, %(parenttype)s, 'entries',
+                ROW_NUMBER() OVER (ORDER BY posting_date, name),
+                %(user)s, %(user)s, %(now)s, %(now)s,
+                account, party_type, party, cost_center, debit, credit, name,
+                account, cost_center, debit, credit,
+                debit_in_account_currency, credit_in_account_currency,
+                debit_in_transaction_currency, credit_in_transaction_currency
+            FROM `tabGL Entry`
+            WHERE company = %(company)s
+                AND voucher_type = %(voucher_type)s
+                AND voucher_no = %(voucher_no)s
+                AND is_cancelled = 0
+            """,
+            {
+                "parent": self.name,
+                "parenttype": self.doctype,
+                "user": frappe.session.user,
+                "now": now(),
+                "company": company,
+                "voucher_type": voucher_type,
+                "voucher_no": voucher_no,
             },
-            fields=[
-                "name",
-                "account",
-                "party_type",
-                "party",
-                "cost_center",
-                "debit",
-                "credit",
-                "debit_in_account_currency",
-                "credit_in_account_currency",
-                "debit_in_transaction_currency",
-                "credit_in_transaction_currency",
-            ],
-            order_by="posting_date asc, name asc",
         )
 
-        if not gl_entries:
+        self.reload()
+
+        if not self.entries:
             frappe.throw(
                 _(
                     "No GL Entries found for {0} {1} in company {2}."
-                ).format(self.voucher_type, self.voucher_no, self.company)
-            )
-
-        self.set("entries", [])
-
-        for gle in gl_entries:
-            self.append(
-                "entries",
-                {
-
-                    "account": gle.account,
-                    "party_type": gle.party_type,
-                    "party": gle.party,
-                    "cost_center": gle.cost_center,
-                    "debit": flt(gle.debit),
-                    "credit": flt(gle.credit),
-                    "reference_gl_entry": gle.name,
-
-                    "original_account": gle.account,
-                    "original_cost_center": gle.cost_center,
-                    "original_debit": flt(gle.debit),
-                    "original_credit": flt(gle.credit),
-                    "original_debit_in_account_currency": flt(gle.debit_in_account_currency),
-                    "original_credit_in_account_currency": flt(gle.credit_in_account_currency),
-                    "original_debit_in_transaction_currency": flt(gle.debit_in_transaction_currency),
-                    "original_credit_in_transaction_currency": flt(gle.credit_in_transaction_currency),
-                },
+                ).format(voucher_type, voucher_no, company)
             )
 
+        # Bumps modified too, so stale open copies can't sync the old lines back
         self.update_totals()
-        self.save(ignore_permissions=True)
+        frappe.db.set_value(
+            self.doctype,
+            self.name,
+            {
+                "total_debit": self.total_debit,
+                "total_credit": self.total_credit,
+                "difference": self.difference,
+            },
+        )
 
         frappe.msgprint(
             _(
                 "Fetched {0} GL Entries from {1} {2}."
-            ).format(len(gl_entries), self.voucher_type, self.voucher_no),
+            ).format(len(self.entries), voucher_type, voucher_no),
             alert=True,
         )
 
         return {
-            "count": len(gl_entries),
+            "count": len(self.entries),
             "total_debit": self.total_debit,
             "total_credit": self.total_credit,
         }
@@ -186,39 +231,53 @@ class GLCorrection(Document):
         if self.docstatus != 1:
             frappe.throw(_("Apply GL Updates is only allowed after submission (docstatus = 1)."))
 
-        updated = 0
+        gl_entries = get_gl_entries_by_name(
+            [row.reference_gl_entry for row in self.entries or [] if row.reference_gl_entry]
+        )
+
+        pending = {}
 
         for row in self.entries or []:
             gle_name = row.reference_gl_entry
             if not gle_name:
                 continue
 
-            update_gl_entry_amounts(gle_name, flt(row.debit), flt(row.credit))
+            gle = gl_entries.get(gle_name)
+            if not gle:
+                frappe.throw(_("GL Entry {0} not found").format(gle_name))
 
-            updates = {}
+            # Only touch what was actually edited against the snapshot
+            if flt(row.debit) == flt(row.original_debit) and flt(row.credit) == flt(
+                row.original_credit
+            ):
+                updates = {}
+            else:
+                updates = get_gl_entry_amount_updates(row, flt(row.debit), flt(row.credit))
 
-            if row.account:
-                current_account = frappe.db.get_value("GL Entry", gle_name, "account")
-                if current_account != row.account:
-                    updates["account"] = row.account
+            if (
+                row.account
+                and row.account != row.original_account
+                and gle.account != row.account
+            ):
+                updates["account"] = row.account
 
-            if row.cost_center:
-                current_cc = frappe.db.get_value("GL Entry", gle_name, "cost_center")
-                if current_cc != row.cost_center:
-                    updates["cost_center"] = row.cost_center
+            if (
+                row.cost_center
+                and row.cost_center != row.original_cost_center
+                and gle.cost_center != row.cost_center
+            ):
+                updates["cost_center"] = row.cost_center
 
-            if updates:
-                frappe.db.set_value("GL Entry", gle_name, updates, update_modified=False)
+            pending[gle_name] = updates
 
-            updated += 1
+        bulk_update_gl_entries(pending)
+        updated = len(pending)
 
-        self.status = "GL Updated"
-        frappe.db.set_value(self.doctype, self.name, "status", "GL Updated")
+        self.db_set("status", "GL Updated", update_modified=False)
 
         frappe.db.commit()
 
-        self.add_comment(
-            "Info",
+        self.enqueue_info_comment(
             _(
                 "Apply GL Updates executed. {0} GL Entry row(s) updated."
             ).format(updated),
@@ -244,27 +303,17 @@ class GLCorrection(Document):
         if self.docstatus != 1:
             frappe.throw(_("Validation is only meaningful after submission."))
 
+        gl_entries = get_gl_entries_by_name(
+            [row.reference_gl_entry for row in self.entries or [] if row.reference_gl_entry]
+        )
+
         mismatches = []
 
         for row in self.entries or []:
             if not row.reference_gl_entry:
                 continue
 
-            gle = frappe.db.get_value(
-                "GL Entry",
-                row.reference_gl_entry,
-                [
-                    "account",
-                    "cost_center",
-                    "debit",
-                    "credit",
-                    "debit_in_account_currency",
-                    "credit_in_account_currency",
-                    "debit_in_transaction_currency",
-                    "credit_in_transaction_currency",
-                ],
-                as_dict=True,
-            )
+            gle = gl_entries.get(row.reference_gl_entry)
 
             if not gle:
                 mismatches.append(f"{row.reference_gl_entry}: GL Entry not found")
@@ -320,33 +369,30 @@ class GLCorrection(Document):
         if self.docstatus != 1:
             frappe.throw(_("Rollback is only allowed after submission."))
 
-        restored = 0
+        pending = {}
 
         for row in self.entries or []:
             if not row.reference_gl_entry:
                 continue
 
-            restore_gl_entry_originals(row)
+            updates = get_gl_entry_original_values(row)
+            pending[row.reference_gl_entry] = updates
 
-            if hasattr(row, "original_debit"):
-                row.debit = flt(row.original_debit)
-            if hasattr(row, "original_credit"):
-                row.credit = flt(row.original_credit)
+            row.debit = updates.get("debit", row.debit)
+            row.credit = updates.get("credit", row.credit)
 
-            restored += 1
+        bulk_update_gl_entries(pending)
+        restored = len(pending)
 
         self.update_totals()
 
-        self.flags.ignore_validate_update_after_submit = True
-
+        # Status goes out with the same save as the restored rows
         self.status = "Rolled Back"
-
-
+        self.flags.ignore_validate_update_after_submit = True
         self.save(ignore_permissions=True)
         frappe.db.commit()
 
-        self.add_comment(
-            "Info",
+        self.enqueue_info_comment(
             _("Rollback executed. Restored {0} GL Entry row(s) to original values.").format(
                 restored
             ),
@@ -372,11 +418,12 @@ class GLCorrection(Document):
         if self.docstatus != 1:
             frappe.throw(_("Please submit this GL Correction before reposting valuation."))
 
-        if not self.company or not self.voucher_type or not self.voucher_no:
-            frappe.throw(_("Please set Company, Voucher Type and Voucher No first."))
+        company, voucher_type, voucher_no = self.company, self.voucher_type, self.voucher_no
 
+        if not company or not voucher_type or not voucher_no:
+            frappe.throw(_("Please set Company, Voucher Type and Voucher No first."))
 
-        if not frappe.db.exists("DocType", "Repost Item Valuation"):
+        if not riv_available():
             msg = _(
                 "Repost Item Valuation DocType is not available in this system. "
                 "GL entries are updated, but stock valuation must be adjusted "
@@ -387,25 +434,20 @@ class GLCorrection(Document):
             return {"created": 0}
 
 
-        if self.voucher_type not in (
-            "Purchase Receipt",
-            "Stock Entry",
-            "Purchase Invoice",
-            "Sales Invoice",
-        ):
+        if voucher_type not in _STOCK_VOUCHER_TYPES:
             warn_msg = _(
                 "Repost Item Valuation is normally used for stock-related vouchers. "
                 "Current Voucher Type: {0}"
-            ).format(self.voucher_type)
+            ).format(voucher_type)
             frappe.msgprint(warn_msg, alert=True, indicator="orange")
             self.add_comment("Info", warn_msg)
 
         riv = frappe.new_doc("Repost Item Valuation")
-        riv.company = self.company
-        riv.voucher_type = self.voucher_type
-        riv.voucher_no = self.voucher_no
+        riv.company = company
+        riv.voucher_type = voucher_type
+        riv.voucher_no = voucher_no
 
-        if riv.meta.has_field("posting_date"):
+        if riv_has_posting_date():
             riv.posting_date = self.posting_date or nowdate()
 
         riv.insert(ignore_permissions=True)
@@ -413,23 +455,70 @@ class GLCorrection(Document):
 
         log_msg = _(
             "Repost Item Valuation {0} created and submitted for {1} {2} at {3}."
-        ).format(riv.name, self.voucher_type, self.voucher_no, now())
+        ).format(riv.name, voucher_type, voucher_no, now())
         self.add_comment("Info", log_msg)
 
         frappe.msgprint(
             _(
                 "Repost Item Valuation <b>{0}</b> created for {1} {2}. "
                 "It will be processed in the background."
-            ).format(riv.name, self.voucher_type, self.voucher_no),
+            ).format(riv.name, voucher_type, voucher_no),
             alert=True,
         )
 
         return {"created": 1, "repost_name": riv.name}
 
+    def enqueue_info_comment(self, text):
+        """
+        Add an "Info" timeline comment from a background job so the
+        Comment insert stays out of the GL update request.
+        """
+        frappe.enqueue(
+            "gl_fix_tool.gl_fix_tool.doctype.gl_correction.gl_correction.add_info_comment",
+            queue="short",
+            enqueue_after_commit=True,
+            reference_doctype=self.doctype,
+            reference_name=self.name,
+            content=text,
+        )
+
 
-def update_gl_entry_amounts(gl_entry_name, new_debit, new_credit):
+def add_info_comment(reference_doctype, reference_name, content):
+    """Insert an "Info" Comment, same as Document.add_comment("Info", ...)."""
+
+    frappe.get_doc(
+        {
+            "doctype": "Comment",
+            "comment_type": "Info",
+            "comment_email": frappe.session.user,
+            "reference_doctype": reference_doctype,
+            "reference_name": reference_name,
+            "content": content,
+        }
+    ).insert(ignore_permissions=True)
+
+
+def get_gl_entries_by_name(names):
+    """
+    Fetch the account, cost center and all amount fields of the given
+    GL Entries in a single query, keyed by GL Entry name.
     """
-    Update all relevant amount fields on a GL Entry in a consistent way:
+
+    if not names:
+        return {}
+
+    rows = frappe.get_all(
+        "GL Entry",
+        filters={"name": ["in", list(names)]},
+        fields=["name", *_GLE_CHECK_FIELDS],
+    )
+
+    return {r.name: r for r in rows}
+
+
+def get_gl_entry_amount_updates(snapshot, new_debit, new_credit):
+    """
+    Compute all relevant amount fields for a GL Entry in a consistent way:
 
       - debit
       - debit_in_account_currency
@@ -437,95 +526,120 @@ def update_gl_entry_amounts(gl_entry_name, new_debit, new_credit):
       - credit
       - credit_in_account_currency
       - credit_in_transaction_currency
+
+    Account / transaction currency amounts are scaled by the same factor
+    as debit / credit, relative to the original_* amounts captured on the
+    GL Correction Line (`snapshot`), so no GL Entry read is needed.
+    Nothing is written here.
     """
 
-    fields = [
-        "debit",
-        "credit",
-        "debit_in_account_currency",
-        "credit_in_account_currency",
-        "debit_in_transaction_currency",
-        "credit_in_transaction_currency",
-    ]
+    updates = {}
 
-    gle = frappe.db.get_value("GL Entry", gl_entry_name, fields, as_dict=True)
-    if not gle:
-        frappe.throw(_("GL Entry {0} not found").format(gl_entry_name))
+    for side, new, old in (
+        ("debit", flt(new_debit), flt(snapshot.original_debit)),
+        ("credit", flt(new_credit), flt(snapshot.original_credit)),
+    ):
+        if not (old or new):
+            continue
 
-    old_debit = flt(gle.debit)
-    old_credit = flt(gle.credit)
+        old_acc = flt(snapshot.get(f"original_{side}_in_account_currency"))
+        old_trn = flt(snapshot.get(f"original_{side}_in_transaction_currency"))
 
-    nd = flt(new_debit)
-    nc = flt(new_credit)
+        updates[side] = new
 
-    updates = {}
-    if old_debit or nd:
-        updates["debit"] = nd
-        debit_factor = nd / old_debit if old_debit else None
-        old_d_acc = flt(gle.debit_in_account_currency)
-        if old_d_acc or debit_factor is not None:
-            if old_debit and debit_factor is not None:
-                updates["debit_in_account_currency"] = flt(old_d_acc * debit_factor)
-            else:
-                updates["debit_in_account_currency"] = nd
-        old_d_trn = flt(gle.debit_in_transaction_currency)
-        if old_d_trn or debit_factor is not None:
-            if old_debit and debit_factor is not None:
-                updates["debit_in_transaction_currency"] = flt(old_d_trn * debit_factor)
-            else:
-                updates["debit_in_transaction_currency"] = 0 if nd == 0 else old_d_trn
-    if old_credit or nc:
-        updates["credit"] = nc
-        credit_factor = nc / old_credit if old_credit else None
-        old_c_acc = flt(gle.credit_in_account_currency)
-        if old_c_acc or credit_factor is not None:
-            if old_credit and credit_factor is not None:
-                updates["credit_in_account_currency"] = flt(old_c_acc * credit_factor)
-            else:
-                updates["credit_in_account_currency"] = nc
-        old_c_trn = flt(gle.credit_in_transaction_currency)
-        if old_c_trn or credit_factor is not None:
-            if old_credit and credit_factor is not None:
-                updates["credit_in_transaction_currency"] = flt(old_c_trn * credit_factor)
-            else:
-                updates["credit_in_transaction_currency"] = 0 if nc == 0 else old_c_trn
+        for fieldname, value in (
+            (f"{side}_in_account_currency", _scale(new, old, old_acc, new)),
+            (f"{side}_in_transaction_currency", _scale(new, old, old_trn, old_trn if new else 0)),
+        ):
+            if value is not None:
+                updates[fieldname] = value
 
-    if updates:
-        frappe.db.set_value("GL Entry", gl_entry_name, updates, update_modified=False)
+    return updates
 
 
-def restore_gl_entry_originals(row):
+def _scale(new, old, old_currency, fallback):
     """
-    Restore GL Entry fields from snapshot stored on GL Correction Line row.
+    Scale a currency amount by new / old.
+
+    Without an old base amount, `fallback` is used when the currency
+    amount is set; None means "leave the field unchanged".
     """
 
-    if not row.reference_gl_entry:
-        return
+    if old:
+        return flt(old_currency * (new / old))
+
+    return fallback if old_currency else None
+
+
+def get_gl_entry_original_values(row):
+    """
+    Build the GL Entry field values captured in the snapshot
+    of a GL Correction Line row.
+    """
 
     updates = {}
 
-    if getattr(row, "original_account", None):
-        updates["account"] = row.original_account
-    if getattr(row, "original_cost_center", None):
-        updates["cost_center"] = row.original_cost_center
-
-    if hasattr(row, "original_debit"):
-        updates["debit"] = flt(row.original_debit)
-    if hasattr(row, "original_credit"):
-        updates["credit"] = flt(row.original_credit)
-    if hasattr(row, "original_debit_in_account_currency"):
-        updates["debit_in_account_currency"] = flt(row.original_debit_in_account_currency)
-    if hasattr(row, "original_credit_in_account_currency"):
-        updates["credit_in_account_currency"] = flt(row.original_credit_in_account_currency)
-    if hasattr(row, "original_debit_in_transaction_currency"):
-        updates["debit_in_transaction_currency"] = flt(row.original_debit_in_transaction_currency)
-    if hasattr(row, "original_credit_in_transaction_currency"):
-        updates["credit_in_transaction_currency"] = flt(row.original_credit_in_transaction_currency)
-
-    if updates:
-        frappe.db.set_value(
-            "GL Entry",
-            row.reference_gl_entry,
-            updates,
-            update_modified=False,
-        )
\ No newline at end of file
+    for source, target in _ORIG_MAP.items():
+        value = row.get(source)
+
+        if target in _GLE_AMOUNT_FIELDS:
+            updates[target] = flt(value)
+        elif value:
+            # Links are only restored when a snapshot value exists
+            updates[target] = value
+
+    return updates
+
+
+def bulk_update_gl_entries(updates_by_name, batch_size=500):
+    """
+    Write per-entry field values to GL Entry, one UPDATE per `batch_size`
+    entries:
+
+      UPDATE `tabGL Entry`
+      SET debit = CASE name WHEN %s THEN %s ... ELSE debit END, ...
+      WHERE name IN (...)
+
+    `updates_by_name` maps GL Entry name -> {fieldname: value}.
+    Entries with no updates are skipped. Nothing is committed here.
+    """
+
+    names = [name for name, updates in updates_by_name.items() if updates]
+
+    for start in range(0, len(names), batch_size):
+        _update_gl_entries_batch(
+            {name: updates_by_name[name] for name in names[start : start + batch_size]}
+        )
+
+
+def _update_gl_entries_batch(updates_by_name):
+    columns = []
+    for updates in updates_by_name.values():
+        for column in updates:
+            if column not in _GLE_CHECK_FIELDS:
+                frappe.throw(_("Field {0} cannot be updated on GL Entry").format(column))
+            if column not in columns:
+                columns.append(column)
+
+    set_clauses = []
+    values = []
+
+    for column in columns:
+        whens = []
+        for name, updates in updates_by_name.items():
+            if column in updates:
+                whens.append("WHEN %s THEN %s")
+                values.extend((name, updates[column]))
+
+        set_clauses.append(
+            "`{0}` = CASE `name` {1} ELSE `{0}` END".format(column, " ".join(whens))
+        )
+
+    values.extend(updates_by_name)
+
+    frappe.db.sql(
+        "UPDATE `tabGL Entry` SET {0} WHERE `name` IN ({1})".format(
+            ", ".join(set_clauses), ", ".join(["%s"] * len(updates_by_name))
+        ),
+        values,
+    )
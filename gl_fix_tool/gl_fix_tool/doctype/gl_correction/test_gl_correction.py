@@ -1,9 +1,145 @@
 # Copyright (c) 2025, Gl Fix Tool and Contributors
 # See license.txt
 
-# import frappe
+import frappe
 from frappe.tests.utils import FrappeTestCase
 
+from gl_fix_tool.gl_fix_tool.doctype.gl_correction.gl_correction import (
+	bulk_update_gl_entries,
+	get_gl_entry_amount_updates,
+	get_gl_entry_original_values,
+)
+
+
+def make_gl_entries(*rows):
+	"""Insert bare GL Entry rows (name, account, cost_center, debit, credit) without validation."""
+	frappe.db.bulk_insert(
+		"GL Entry", ["name", "account", "cost_center", "debit", "credit"], rows
+	)
+
+
+def get_gl_entry_values(name):
+	return frappe.db.get_value(
+		"GL Entry", name, ["account", "cost_center", "debit", "credit"], as_dict=True
+	)
+
+
+def make_snapshot(debit=0, credit=0, debit_acc=0, credit_acc=0, debit_trn=0, credit_trn=0):
+	return frappe._dict(
+		original_debit=debit,
+		original_credit=credit,
+		original_debit_in_account_currency=debit_acc,
+		original_credit_in_account_currency=credit_acc,
+		original_debit_in_transaction_currency=debit_trn,
+		original_credit_in_transaction_currency=credit_trn,
+	)
+
 
 class TestGLCorrection(FrappeTestCase):
-	pass
+	def test_amount_updates_truth_table(self):
+		cases = [
+			# old amounts scaled by new / old
+			(
+				make_snapshot(debit=100, debit_acc=200, debit_trn=300),
+				(50, 0),
+				{"debit": 50, "debit_in_account_currency": 100, "debit_in_transaction_currency": 150},
+			),
+			# no old amounts at all -> only debit
+			(make_snapshot(), (10, 0), {"debit": 10}),
+			# no old base amount -> account currency follows, transaction kept
+			(
+				make_snapshot(debit_acc=5, debit_trn=7),
+				(10, 0),
+				{"debit": 10, "debit_in_account_currency": 10, "debit_in_transaction_currency": 7},
+			),
+			# zero stays zero -> nothing to write
+			(make_snapshot(debit_acc=5, debit_trn=7), (0, 0), {}),
+			# credit cleared -> all credit amounts zeroed
+			(
+				make_snapshot(credit=40, credit_acc=40, credit_trn=40),
+				(0, 0),
+				{"credit": 0, "credit_in_account_currency": 0, "credit_in_transaction_currency": 0},
+			),
+		]
+
+		for snapshot, (new_debit, new_credit), expected in cases:
+			self.assertEqual(get_gl_entry_amount_updates(snapshot, new_debit, new_credit), expected)
+
+	def test_bulk_update_writes_only_listed_names_and_columns(self):
+		if not frappe.db.table_exists("GL Entry"):
+			self.skipTest("GL Entry (ERPNext) is not installed")
+
+		make_gl_entries(
+			("_Test GLC Entry 1", "_Test Account A", "_Test CC A", 100, 0),
+			("_Test GLC Entry 2", "_Test Account A", "_Test CC A", 0, 100),
+			("_Test GLC Entry 3", "_Test Account A", "_Test CC A", 50, 0),
+			("_Test GLC Entry 4", "_Test Account A", "_Test CC A", 0, 50),
+		)
+
+		for batch_size in (500, 1):
+			bulk_update_gl_entries(
+				{
+					"_Test GLC Entry 1": {"debit": 80},
+					"_Test GLC Entry 2": {"credit": 80, "account": "_Test Account B"},
+					"_Test GLC Entry 3": {},
+				},
+				batch_size=batch_size,
+			)
+
+			# Columns set for one entry keep their value on the others (ELSE branch)
+			self.assertEqual(
+				get_gl_entry_values("_Test GLC Entry 1"),
+				{"account": "_Test Account A", "cost_center": "_Test CC A", "debit": 80, "credit": 0},
+			)
+			self.assertEqual(
+				get_gl_entry_values("_Test GLC Entry 2"),
+				{"account": "_Test Account B", "cost_center": "_Test CC A", "debit": 0, "credit": 80},
+			)
+
+			# Entries without updates or not listed at all are untouched
+			self.assertEqual(
+				get_gl_entry_values("_Test GLC Entry 3"),
+				{"account": "_Test Account A", "cost_center": "_Test CC A", "debit": 50, "credit": 0},
+			)
+			self.assertEqual(
+				get_gl_entry_values("_Test GLC Entry 4"),
+				{"account": "_Test Account A", "cost_center": "_Test CC A", "debit": 0, "credit": 50},
+			)
+
+	def test_bulk_update_rejects_other_columns(self):
+		for column in ("voucher_no", "is_cancelled", "debit`=0, `credit"):
+			self.assertRaises(
+				frappe.ValidationError,
+				bulk_update_gl_entries,
+				{"_Test GLC Entry 1": {column: 1}},
+			)
+
+	def test_original_values_skip_empty_links(self):
+		row = frappe._dict(
+			original_account=None,
+			original_cost_center="",
+			original_debit=25,
+			original_credit=None,
+			original_debit_in_account_currency=50,
+			original_credit_in_account_currency=None,
+			original_debit_in_transaction_currency=None,
+			original_credit_in_transaction_currency=None,
+		)
+
+		# Links are only restored from a snapshot value, amounts always
+		self.assertEqual(
+			get_gl_entry_original_values(row),
+			{
+				"debit": 25,
+				"credit": 0,
+				"debit_in_account_currency": 50,
+				"credit_in_account_currency": 0,
+				"debit_in_transaction_currency": 0,
+				"credit_in_transaction_currency": 0,
+			},
+		)
+
+		row.update(original_account="_Test Account A", original_cost_center="_Test CC A")
+		values = get_gl_entry_original_values(row)
+		self.assertEqual(values["account"], "_Test Account A")
+		self.assertEqual(values["cost_center"], "_Test CC A")
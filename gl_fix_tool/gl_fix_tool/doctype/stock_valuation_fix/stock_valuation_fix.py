@@ -1,7 +1,9 @@
 import frappe
 from frappe import _
 from frappe.model.document import Document
-from frappe.utils import flt, nowdate
+from frappe.utils import flt, money_in_words, now, nowdate
+
+from gl_fix_tool.utils import riv_available, riv_has_posting_date
 
 
 class StockValuationFix(Document):
@@ -23,10 +25,13 @@ class StockValuationFix(Document):
         """Recalculate target totals on Save / Submit."""
         self.update_totals()
 
-    def on_submit(self):
+    def before_submit(self):
         """
         Require that we have at least fetched and previewed
         an adjustment before allowing actions.
+
+        Runs before the submit write, so the status set here is
+        saved with it and needs no UPDATE of its own.
         """
         if not self.qty_on_hand:
             frappe.throw(
@@ -38,24 +43,40 @@ class StockValuationFix(Document):
 
         if not self.status or self.status == "Draft":
             self.status = "Previewed"
-            frappe.db.set_value(self.doctype, self.name, "status", self.status)
+
+    def write_computed_values(self):
+        """
+        Persist the freshly computed values with a single UPDATE instead of
+        a full save, which would only run validate / update_totals again.
+
+        The whole row is written (not just the computed columns) so that
+        unsaved edits to Item / Warehouse / Target Rate are kept as well.
+        Only drafts may be written this way; modified is bumped so that
+        other open copies of the form fail check_if_latest.
+        """
+        if self.docstatus != 0:
+            frappe.throw(_("Fetch and Preview are only allowed while the document is in Draft."))
+
+        if self.is_new():
+            self.insert(ignore_permissions=True)
+        else:
+            self.set_user_and_timestamp()
+            self.db_update()
 
     def update_totals(self):
         """Recompute current/target totals if data is present."""
-        qty = flt(self.qty_on_hand)
-        cur_rate = flt(self.current_valuation_rate)
-        tgt_rate = flt(self.target_valuation_rate)
+        qty = float(self.qty_on_hand or 0)
+        cur_rate = float(self.current_valuation_rate or 0)
+        tgt_rate = float(self.target_valuation_rate or 0)
 
-        # Current total value
-        self.current_total_value = qty * cur_rate if qty and cur_rate else 0
+        # A zero qty or rate already makes the product 0
+        self.current_total_value = qty * cur_rate
+        self.target_total_value = qty * tgt_rate
 
-        # Target total value & difference
-        if qty and tgt_rate:
-            self.target_total_value = qty * tgt_rate
-            self.difference_value = self.target_total_value - self.current_total_value
-        else:
-            self.target_total_value = 0
-            self.difference_value = 0
+        # No target rate yet means no difference, not "minus the current value"
+        self.difference_value = (
+            self.target_total_value - self.current_total_value if tgt_rate else 0
+        )
 
     @frappe.whitelist()
     def fetch_current_state(self):
@@ -68,14 +89,9 @@ class StockValuationFix(Document):
                 _("Please set Company, Item and Warehouse before fetching current valuation.")
             )
 
-        bin_doc = frappe.db.get_value(
-            "Bin",
-            {"item_code": self.item_code, "warehouse": self.warehouse},
-            ["actual_qty", "valuation_rate"],
-            as_dict=True,
-        )
+        bin_state = get_bin_state(self.item_code, self.warehouse)
 
-        if not bin_doc:
+        if not bin_state:
             frappe.msgprint(
                 _(
                     "No Bin record found for Item {0} in Warehouse {1}. "
@@ -86,12 +102,12 @@ class StockValuationFix(Document):
             self.qty_on_hand = 0
             self.current_valuation_rate = 0
         else:
-            self.qty_on_hand = flt(bin_doc.actual_qty)
-            self.current_valuation_rate = flt(bin_doc.valuation_rate)
+            self.qty_on_hand = flt(bin_state[0])
+            self.current_valuation_rate = flt(bin_state[1])
 
         self.update_totals()
         self.status = "Valuation Fetched"
-        self.save(ignore_permissions=True)
+        self.write_computed_values()
 
         frappe.msgprint(
             _(
@@ -129,7 +145,7 @@ class StockValuationFix(Document):
 
         self.update_totals()
         self.status = "Previewed"
-        self.save(ignore_permissions=True)
+        self.write_computed_values()
 
         frappe.msgprint(
             _(
@@ -154,8 +170,11 @@ class StockValuationFix(Document):
         if not self.item_code or not self.warehouse:
             frappe.throw(_("Please set Item and Warehouse first."))
 
-        item = frappe.get_doc("Item", self.item_code)
-        if not (getattr(item, "has_serial_no", 0) or getattr(item, "has_batch_no", 0)):
+        # Read-only lookup, served from the document cache
+        item = frappe.get_cached_value(
+            "Item", self.item_code, ["has_serial_no", "has_batch_no"], as_dict=True
+        )
+        if not item or not (item.has_serial_no or item.has_batch_no):
             frappe.msgprint(
                 _("Item {0} is not serial/batch tracked.").format(self.item_code),
                 alert=True,
@@ -171,12 +190,13 @@ class StockValuationFix(Document):
             },
             fields=[
                 "parent",
-                "warehouse",
                 "qty",
                 "serial_no",
                 "batch_no",
             ],
+            order_by="parent",
             limit=200,
+            as_list=True,
         )
 
         if not rows:
@@ -188,38 +208,29 @@ class StockValuationFix(Document):
             )
             return
 
-        total_qty = sum(flt(r.qty) for r in rows)
+        # Total over all bundles, not just the rows shown below
+        total_qty = flt(
+            frappe.db.sql(
+                """
+                SELECT COALESCE(SUM(qty), 0)
+                FROM `tabSerial and Batch Bundle Item`
+                WHERE item_code = %s AND warehouse = %s
+                """,
+                (self.item_code, self.warehouse),
+            )[0][0]
+        )
 
-        html = [
-            "<h4>Serial & Batch Bundles</h4>",
-            "<p>Item: <b>{}</b>, Warehouse: <b>{}</b></p>".format(
-                self.item_code, self.warehouse
-            ),
-            "<p>Total Qty in bundles: <b>{}</b></p>".format(total_qty),
-            "<table class='table table-bordered table-condensed'>",
-            "<thead><tr>",
-            "<th>Bundle</th><th>Qty</th><th>Batch</th><th>Serials</th>",
-            "</tr></thead><tbody>",
-        ]
-
-        for r in rows:
-            html.append(
-                "<tr>"
-                "<td>{parent}</td>"
-                "<td style='text-align:right'>{qty}</td>"
-                "<td>{batch}</td>"
-                "<td style='max-width:300px; word-wrap:break-word;'>{serials}</td>"
-                "</tr>".format(
-                    parent=r.parent,
-                    qty=flt(r.qty),
-                    batch=r.batch_no or "",
-                    serials=(r.serial_no or "").replace("\n", ", "),
-                )
+        frappe.msgprint(
+            frappe.render_template(
+                "gl_fix_tool/templates/serial_batch_summary.html",
+                {
+                    "item_code": self.item_code,
+                    "warehouse": self.warehouse,
+                    "total_qty": total_qty,
+                    "rows": rows,
+                },
             )
-
-        html.append("</tbody></table>")
-
-        frappe.msgprint("".join(html))
+        )
 
     @frappe.whitelist()
     def update_source_entry(self):
@@ -251,31 +262,23 @@ class StockValuationFix(Document):
                   "Selected: {0}").format(self.source_voucher_type)
             )
 
-        pr = frappe.get_doc("Purchase Receipt", self.source_voucher_no)
+        pr_name = self.source_voucher_no
         new_rate = flt(self.target_valuation_rate)
-        conversion_rate = flt(pr.get("conversion_rate") or 1)
-
-        rows_to_update = []
 
         # 1) Specific row selected
         if self.source_row_name:
-            for row in pr.items:
-                if row.name == self.source_row_name:
-                    rows_to_update.append(row)
-                    break
+            rows_to_update = get_purchase_receipt_items(pr_name, row_name=self.source_row_name)
 
             if not rows_to_update:
                 frappe.throw(
                     _("Source Row Name {0} not found in Purchase Receipt {1}.")
-                    .format(self.source_row_name, pr.name)
+                    .format(self.source_row_name, pr_name)
                 )
         else:
             # 2) Auto-select all rows with same item (+ optional warehouse)
-            rows_to_update = [
-                row for row in pr.items
-                if row.item_code == self.item_code
-                and (not row.warehouse or row.warehouse == self.warehouse)
-            ]
+            rows_to_update = get_purchase_receipt_items(
+                pr_name, item_code=self.item_code, warehouse=self.warehouse
+            )
 
             if not rows_to_update:
                 frappe.throw(
@@ -283,48 +286,22 @@ class StockValuationFix(Document):
                         "No matching Purchase Receipt Item found in {0} "
                         "for Item {1} and Warehouse {2}. "
                         "Please set Source Row Name manually."
-                    ).format(pr.name, self.item_code, self.warehouse)
+                    ).format(pr_name, self.item_code, self.warehouse)
                 )
 
         updated_rows = []
-        first_old_rate = None
+        # rows_to_update is never empty here, see the throws above
+        first_old_rate = float(rows_to_update[0][1] or 0)
 
-        for row in rows_to_update:
-            old_rate = flt(row.rate)
-
-            if first_old_rate is None:
-                first_old_rate = old_rate
+        # Rates come straight from the DB (Decimal / None), plain float() is enough
+        for row_name, rate in rows_to_update:
+            old_rate = float(rate or 0)
 
             # Skip if same rate already
             if abs(old_rate - new_rate) < 0.0000001:
                 continue
 
-            qty = flt(row.qty)
-            amount = qty * new_rate
-            base_rate = new_rate * conversion_rate
-            base_amount = amount * conversion_rate
-
-            # Main rate fields
-            row.rate = new_rate
-            if hasattr(row, "valuation_rate"):
-                row.valuation_rate = new_rate
-            if hasattr(row, "amount"):
-                row.amount = amount
-
-            if hasattr(row, "base_rate"):
-                row.base_rate = base_rate
-            if hasattr(row, "base_amount"):
-                row.base_amount = base_amount
-            if hasattr(row, "net_rate"):
-                row.net_rate = new_rate
-            if hasattr(row, "net_amount"):
-                row.net_amount = amount
-            if hasattr(row, "base_net_rate"):
-                row.base_net_rate = base_rate
-            if hasattr(row, "base_net_amount"):
-                row.base_net_amount = base_amount
-
-            updated_rows.append((row.name, old_rate, new_rate))
+            updated_rows.append((row_name, old_rate, new_rate))
 
         if not updated_rows:
             frappe.msgprint(
@@ -334,43 +311,73 @@ class StockValuationFix(Document):
             )
             return {"updated": 0, "new_rate": new_rate}
 
-        # Allow update after submit
-        pr.flags.ignore_validate_update_after_submit = True
-        pr.flags.ignore_mandatory = True
-        pr.flags.ignore_links = True
-
-        try:
-            if hasattr(pr, "calculate_taxes_and_totals"):
-                pr.calculate_taxes_and_totals()
-        except Exception:
-            frappe.log_error(frappe.get_traceback(), "Stock Valuation Fix: calculate_taxes_and_totals failed")
+        # Nothing of the Purchase Receipt itself is read before we know
+        # that at least one row really changes.
+        pr_header = frappe.db.get_value(
+            "Purchase Receipt",
+            pr_name,
+            ["company", "currency", "conversion_rate", "discount_amount", "disable_rounded_total"],
+            as_dict=True,
+        )
+        conversion_rate = flt(pr_header.conversion_rate or 1)
 
-        pr.save(ignore_permissions=True)
+        update_purchase_receipt_item_rates(
+            [name for name, _, _ in updated_rows], new_rate, conversion_rate
+        )
 
-        # Update "Source Current Rate" on this tool for reference
-        if first_old_rate is not None:
-            self.source_current_rate = first_old_rate
+        has_taxes = frappe.db.exists(
+            "Purchase Taxes and Charges", {"parenttype": "Purchase Receipt", "parent": pr_name}
+        )
 
-        self.flags.ignore_validate_update_after_submit = True
-        self.save(ignore_permissions=True)
+        if has_taxes or flt(pr_header.discount_amount) or not pr_header.disable_rounded_total:
+            # Taxes / discount / rounding need the Purchase Receipt controller
+            pr = frappe.get_doc("Purchase Receipt", pr_name)
+
+            try:
+                if hasattr(pr, "calculate_taxes_and_totals"):
+                    pr.calculate_taxes_and_totals()
+            except Exception:
+                frappe.log_error(frappe.get_traceback(), "Stock Valuation Fix: calculate_taxes_and_totals failed")
+
+            # Totals are computed above; write parent, items and taxes as they
+            # are instead of running the whole update-after-submit save again.
+            # modified is bumped so open Purchase Receipt forms go stale.
+            pr.set_user_and_timestamp()
+            pr.db_update_all()
+            pr.clear_cache()
+            pr.notify_update()
+        else:
+            update_purchase_receipt_totals(pr_name, pr_header)
 
         row_summary = ", ".join(
             [f"{name} ({old} → {new_rate})" for name, old, _ in updated_rows]
         )
 
-        pr.add_comment(
-            "Info",
-            _(
-                "Item row(s) {0} rate and amounts updated via Stock Valuation Fix {1}."
-            ).format(row_summary, self.name),
+        insert_info_comments(
+            [
+                (
+                    "Purchase Receipt",
+                    pr_name,
+                    _(
+                        "Item row(s) {0} rate and amounts updated via Stock Valuation Fix {1}."
+                    ).format(row_summary, self.name),
+                ),
+                (
+                    self.doctype,
+                    self.name,
+                    _(
+                        "Updated Purchase Receipt {0} rows {1} to rate {2} and recalculated totals."
+                    ).format(pr_name, row_summary, new_rate),
+                ),
+            ]
         )
 
-        self.add_comment(
-            "Info",
-            _(
-                "Updated Purchase Receipt {0} rows {1} to rate {2} and recalculated totals."
-            ).format(pr.name, row_summary, new_rate),
-        )
+        # Update "Source Current Rate" on this tool for reference.
+        # Only this column changes, so validate / update_totals are not rerun.
+        self.db_set("source_current_rate", first_old_rate)
+
+        # Rows, totals, comments and this document go out in one commit
+        frappe.db.commit()
 
         frappe.msgprint(
             _(
@@ -378,7 +385,7 @@ class StockValuationFix(Document):
                 "Totals and taxes have been recalculated. "
                 "You can now run Repost Item Valuation for this voucher "
                 "to realign stock and GL."
-            ).format(pr.name, row_summary),
+            ).format(pr_name, row_summary),
             alert=True,
         )
 
@@ -400,7 +407,7 @@ class StockValuationFix(Document):
         if self.docstatus != 1:
             frappe.throw(_("Please submit this Stock Valuation Fix before reposting valuation."))
 
-        if not frappe.db.exists("DocType", "Repost Item Valuation"):
+        if not riv_available():
             msg = _(
                 "Repost Item Valuation DocType is not available in this system. "
                 "You must adjust stock valuation manually or enable the RIV tool."
@@ -425,16 +432,13 @@ class StockValuationFix(Document):
         riv.voucher_type = voucher_type
         riv.voucher_no = voucher_no
 
-        if riv.meta.has_field("posting_date"):
+        if riv_has_posting_date():
             riv.posting_date = self.posting_date or nowdate()
 
         riv.insert(ignore_permissions=True)
         riv.submit()
 
-        self.flags.ignore_validate_update_after_submit = True
-        self.riv_document = riv.name
-        self.status = "Completed"
-        self.save(ignore_permissions=True)
+        self.db_set({"riv_document": riv.name, "status": "Completed"})
 
         log_msg = _(
             "Repost Item Valuation {0} created and submitted for {1} {2}."
@@ -450,3 +454,193 @@ class StockValuationFix(Document):
         )
 
         return {"created": 1, "repost_name": riv.name}
+
+
+def insert_info_comments(comments):
+    """
+    Insert "Info" timeline comments with one multi-row INSERT.
+    `comments` is a list of (reference_doctype, reference_name, content).
+    """
+
+    timestamp = now()
+    user = frappe.session.user
+
+    frappe.db.bulk_insert(
+        "Comment",
+        [
+            "name",
+            "creation",
+            "modified",
+            "owner",
+            "modified_by",
+            "comment_type",
+            "comment_email",
+            "reference_doctype",
+            "reference_name",
+            "content",
+        ],
+        [
+            (
+                frappe.generate_hash(length=10),
+                timestamp,
+                timestamp,
+                user,
+                user,
+                "Info",
+                user,
+                reference_doctype,
+                reference_name,
+                content,
+            )
+            for reference_doctype, reference_name, content in comments
+        ],
+    )
+
+
+def get_bin_state(item_code, warehouse):
+    """
+    Return (actual_qty, valuation_rate) of the Bin for Item + Warehouse,
+    or None if there is no Bin.
+    """
+
+    return get_bin_states([(item_code, warehouse)])[(item_code, warehouse)]
+
+
+def get_bin_states(pairs):
+    """
+    Batched get_bin_state for scripts fixing many items: return a dict of
+    (item_code, warehouse) -> (actual_qty, valuation_rate) or None, reading
+    all pairs with one query. Nothing is kept between calls, so values are
+    always current.
+    """
+
+    pairs = list(dict.fromkeys(pairs))
+    if not pairs:
+        return {}
+
+    states = dict.fromkeys(pairs)
+
+    for item_code, warehouse, actual_qty, valuation_rate in frappe.db.sql(
+        """
+        SELECT item_code, warehouse, actual_qty, valuation_rate
+        FROM `tabBin`
+        WHERE (item_code, warehouse) IN ({0})
+        """.format(", ".join(["(%s, %s)"] * len(pairs))),
+        [value for pair in pairs for value in pair],
+    ):
+        states[(item_code, warehouse)] = (actual_qty, valuation_rate)
+
+    return states
+
+
+def update_purchase_receipt_totals(purchase_receipt, header):
+    """
+    Recompute parent totals of a Purchase Receipt that has no taxes,
+    no additional discount and no rounding: they are plain item sums.
+    modified is bumped so open forms of the receipt can't save stale totals.
+    """
+
+    total, base_total = frappe.db.sql(
+        """
+        SELECT COALESCE(SUM(amount), 0), COALESCE(SUM(base_amount), 0)
+        FROM `tabPurchase Receipt Item`
+        WHERE parent = %s AND parenttype = 'Purchase Receipt'
+        """,
+        purchase_receipt,
+    )[0]
+
+    company_currency = frappe.get_cached_value("Company", header.company, "default_currency")
+
+    frappe.db.set_value(
+        "Purchase Receipt",
+        purchase_receipt,
+        {
+            "total": total,
+            "base_total": base_total,
+            "net_total": total,
+            "base_net_total": base_total,
+            "grand_total": total,
+            "base_grand_total": base_total,
+            "in_words": money_in_words(total, header.currency),
+            "base_in_words": money_in_words(base_total, company_currency),
+        },
+    )
+
+    # Rows were changed with raw SQL as well; drop any cached copy
+    frappe.clear_document_cache("Purchase Receipt", purchase_receipt)
+
+
+def update_purchase_receipt_item_rates(row_names, rate, conversion_rate):
+    """
+    Set rate and all derived rate / amount columns of the given Purchase
+    Receipt Item rows with one UPDATE. Amounts follow each row's own qty and
+    are rounded to field precision, as calculate_taxes_and_totals does.
+    """
+
+    # Field presence is checked once for all rows, not per row
+    meta = frappe.get_meta("Purchase Receipt Item")
+    assignments = [
+        "{0} = {1}".format(
+            fieldname,
+            expr.format(frappe.get_precision("Purchase Receipt Item", fieldname))
+            if "{0}" in expr
+            else expr,
+        )
+        for fieldname, expr in (
+            ("rate", "%(rate)s"),
+            ("valuation_rate", "%(rate)s"),
+            ("amount", "ROUND(qty * %(rate)s, {0})"),
+            ("base_rate", "%(base_rate)s"),
+            ("base_amount", "ROUND(qty * %(base_rate)s, {0})"),
+            ("net_rate", "%(rate)s"),
+            ("net_amount", "ROUND(qty * %(rate)s, {0})"),
+            ("base_net_rate", "%(base_rate)s"),
+            ("base_net_amount", "ROUND(qty * %(base_rate)s, {0})"),
+        )
+        if fieldname == "rate" or meta.has_field(fieldname)
+    ]
+
+    frappe.db.sql(
+        """
+        UPDATE `tabPurchase Receipt Item`
+        SET {0}
+        WHERE name IN %(names)s
+        """.format(", ".join(assignments)),
+        {
+            "rate": rate,
+            "base_rate": flt(
+                rate * conversion_rate,
+                frappe.get_precision("Purchase Receipt Item", "base_rate"),
+            ),
+            "names": tuple(row_names),
+        },
+    )
+
+
+def get_purchase_receipt_items(purchase_receipt, row_name=None, item_code=None, warehouse=None):
+    """
+    Fetch only the Purchase Receipt Item rows we may update, either one row
+    by name or all rows for Item + (optional) Warehouse, in row order.
+    Returns plain (name, rate) tuples.
+    """
+
+    conditions = ["parent = %(parent)s", "parenttype = 'Purchase Receipt'"]
+    values = {"parent": purchase_receipt}
+
+    if row_name:
+        conditions.append("name = %(name)s")
+        values["name"] = row_name
+    else:
+        conditions.append("item_code = %(item_code)s")
+        conditions.append("(IFNULL(warehouse, '') = '' OR warehouse = %(warehouse)s)")
+        values.update({"item_code": item_code, "warehouse": warehouse})
+
+    return frappe.db.sql(
+        """
+        SELECT name, rate
+        FROM `tabPurchase Receipt Item`
+        WHERE {0}
+        ORDER BY idx
+        """.format(" AND ".join(conditions)),
+        values,
+    )
@@ -1,9 +1,89 @@
 # Copyright (c) 2025, Gl Fix Tool and Contributors
 # See license.txt
 
-# import frappe
+import frappe
 from frappe.tests.utils import FrappeTestCase
+from frappe.utils import flt
+
+from gl_fix_tool.gl_fix_tool.doctype.stock_valuation_fix.stock_valuation_fix import (
+	get_purchase_receipt_items,
+	update_purchase_receipt_item_rates,
+)
+
+TEST_PR = "_Test SVF PR 1"
+
+
+def make_purchase_receipt_items(*rows):
+	"""Insert bare Purchase Receipt Item rows (name, parent, idx, item_code, warehouse, qty, rate)."""
+	frappe.db.bulk_insert(
+		"Purchase Receipt Item",
+		["name", "parent", "parenttype", "parentfield", "idx", "item_code", "warehouse", "qty", "rate"],
+		[
+			(name, parent, "Purchase Receipt", "items", idx, item_code, warehouse, qty, rate)
+			for name, parent, idx, item_code, warehouse, qty, rate in rows
+		],
+	)
 
 
 class TestStockValuationFix(FrappeTestCase):
-	pass
+	def setUp(self):
+		if not frappe.db.table_exists("Purchase Receipt Item"):
+			self.skipTest("Purchase Receipt Item (ERPNext) is not installed")
+
+		make_purchase_receipt_items(
+			("_Test SVF PRI 1", TEST_PR, 1, "_Test SVF Item A", "_Test SVF WH 1", 3, 10),
+			("_Test SVF PRI 2", TEST_PR, 2, "_Test SVF Item A", "", 7, 10),
+			("_Test SVF PRI 3", TEST_PR, 3, "_Test SVF Item A", "_Test SVF WH 2", 1, 10),
+			("_Test SVF PRI 4", TEST_PR, 4, "_Test SVF Item B", "_Test SVF WH 1", 1, 10),
+			("_Test SVF PRI 5", "_Test SVF PR 2", 1, "_Test SVF Item A", "_Test SVF WH 1", 1, 10),
+		)
+
+	def tearDown(self):
+		frappe.db.rollback()
+
+	def test_named_row_filter(self):
+		# A named row is taken as is, whatever its item / warehouse
+		self.assertEqual(
+			[name for name, _ in get_purchase_receipt_items(TEST_PR, row_name="_Test SVF PRI 3")],
+			["_Test SVF PRI 3"],
+		)
+
+		# ... but only from the given Purchase Receipt
+		self.assertFalse(get_purchase_receipt_items(TEST_PR, row_name="_Test SVF PRI 5"))
+
+	def test_item_warehouse_filter(self):
+		# Same item in the warehouse, plus rows without a warehouse, in row order
+		self.assertEqual(
+			[
+				name
+				for name, _ in get_purchase_receipt_items(
+					TEST_PR, item_code="_Test SVF Item A", warehouse="_Test SVF WH 1"
+				)
+			],
+			["_Test SVF PRI 1", "_Test SVF PRI 2"],
+		)
+
+	def test_rates_and_rounded_amounts(self):
+		rate, conversion_rate = 1.23456, 1.5
+		update_purchase_receipt_item_rates(["_Test SVF PRI 1", "_Test SVF PRI 2"], rate, conversion_rate)
+
+		def precision(fieldname):
+			return frappe.get_precision("Purchase Receipt Item", fieldname)
+
+		base_rate = flt(rate * conversion_rate, precision("base_rate"))
+
+		for name, qty in (("_Test SVF PRI 1", 3), ("_Test SVF PRI 2", 7)):
+			row = frappe.db.get_value(
+				"Purchase Receipt Item",
+				name,
+				["rate", "amount", "base_rate", "base_amount"],
+				as_dict=True,
+			)
+
+			self.assertEqual(flt(row.rate), rate)
+			self.assertEqual(flt(row.amount), flt(qty * rate, precision("amount")))
+			self.assertEqual(flt(row.base_rate), base_rate)
+			self.assertEqual(flt(row.base_amount), flt(qty * base_rate, precision("base_amount")))
+
+		# Rows not listed keep their rate
+		self.assertEqual(flt(frappe.db.get_value("Purchase Receipt Item", "_Test SVF PRI 3", "rate")), 10)
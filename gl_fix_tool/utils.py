@@ -0,0 +1,30 @@
+import frappe
+
+# Site -> whether the Repost Item Valuation DocType exists
+_RIV_AVAILABLE = {}
+
+# Site -> whether Repost Item Valuation has posting_date. That only changes
+# with an ERPNext update (which restarts workers), so it is kept per process.
+_RIV_HAS_POSTING = {}
+
+
+def riv_available():
+    """Whether the Repost Item Valuation DocType exists on this site."""
+    site = frappe.local.site
+
+    if site not in _RIV_AVAILABLE:
+        _RIV_AVAILABLE[site] = bool(frappe.db.exists("DocType", "Repost Item Valuation"))
+
+    return _RIV_AVAILABLE[site]
+
+
+def riv_has_posting_date():
+    """Whether Repost Item Valuation has a posting_date field on this site."""
+    site = frappe.local.site
+
+    if site not in _RIV_HAS_POSTING:
+        _RIV_HAS_POSTING[site] = bool(
+            frappe.get_meta("Repost Item Valuation").get_field("posting_date")
+        )
+
+    return _RIV_HAS_POSTING[site]